@@ -17,9 +17,10 @@
 #    limitations under the License.
 #    _________________________________________________________________________
 
-from sys import argv
+from sys import argv, intern
 from typing import Dict
 from pathlib import Path
+from functools import lru_cache
 import re
 
 # +-------------------------------------------------------------------------+
@@ -86,6 +87,23 @@ kmonad_aliases = {
     "f12": "F12",
 }
 
+# +-------------------------------------------------------------------------+
+# | Key to label translation (cached, aliases are frozen before build)      |
+# +-------------------------------------------------------------------------+
+
+_passthrough = frozenset(('\\\\', '\\"'))
+
+@lru_cache(maxsize=None)
+def _translate(key: str, _get=kmonad_aliases.get) -> str:
+    key = _get(key, key)
+    if len(key) == 1 and key.isalpha():
+        key = key.upper()
+    elif key == 'XX':
+        key = ''
+    elif '\\' in key and key not in _passthrough:
+        key = key.replace('\\', '')
+    return intern(key)
+
 # +-------------------------------------------------------------------------+
 # | Matrix position to label position mapping (keyboard-layout-editor)      |
 # |                                                                         |
@@ -97,12 +115,12 @@ kmonad_aliases = {
 # | Requires {a:0}                                                          |
 # +-------------------------------------------------------------------------+
 
-label_pos = {
-    (0,0): 0,   (0,1): 8,   (0,2): 2,
-    (1,0): 6,   (1,1): 9,   (1,2): 7,
-    (2,0): 1,   (2,1): 10,  (2,2): 3,
-    (3,0): 4,   (3,1): 11,  (3,2): 5,
-}
+label_pos = (
+    (0,  8,  2),
+    (6,  9,  7),
+    (1, 10,  3),
+    (4, 11,  5),
+)
 
 # +-------------------------------------------------------------------------+
 # | Custom options per keycap                                               |
@@ -141,6 +159,7 @@ class Options:
         self.index = dict()
         for m in Options.Pattern.finditer(data):
             self.index[m.group("name")] = m.group("data")
+        self.get = self.index.get
 
     def __call__(self, name: str) -> str:
         return self.index.get(name, None)
@@ -166,8 +185,8 @@ class KeyCap:
         \s*
         keycap
         \s+
-        (?P<data>.+?)
-        (?<!\\)[)]''', re.X | re.DOTALL)
+        (?P<data>[^)\\]*(?:\\.[^)\\]*)*)
+        [)]''', re.X | re.DOTALL)
 
     Colors = re.compile(r'''[(]
         \s*
@@ -202,42 +221,39 @@ class KeyCap:
 
         self.layermap = dict()
         self.colormap = dict()
-        for r, row in enumerate(self.rows):
-            for c, col in enumerate(row):
+        for r in range(4):
+            row = self.rows[r]
+            for c in range(3):
+                col = row[c]
                 if col != '_':
-                    self.layermap[col] = label_pos[(r,c)]
+                    self.layermap[col] = label_pos[r][c]
                     self.colormap[col] = colors[r][c]
-        
+        self._colors_str = self._compute_colors()
 
     def label(self, keys: Dict[str, str]) -> str:
         lab = ["", "", "", "", "", "", "", "", "", "", "", ""]
         for layer, key in keys.items():
             if key:
                 p = self.layermap.get(layer, None)
-                key = self.translate(key)
                 if p is not None:
-                    if key == '\\\\' or key == '\\"':
-                        lab[p] = key
-                    else:
-                        lab[p] = key.replace('\\', '')
-        content = re.sub(r'(\\n)+$', '', "\\n".join(lab))
+                    lab[p] = _translate(key)
+        while lab and not lab[-1]:
+            lab.pop()
+        content = "\\n".join(lab)
         return f'"{content}"'
 
     def get_colors(self):
+        return self._colors_str
+
+    def _compute_colors(self):
         lab = ["", "", "", "", "", "", "", "", "", "", "", ""]
         for layer, pos in self.layermap.items():
             lab[pos] = self.colormap.get(layer, "")
-        content = "\\n".join(lab).rstrip('\\n')
+        while lab and not lab[-1]:
+            lab.pop()
+        content = "\\n".join(lab)
         return f'"{content}"'
 
-    def translate(self, key):
-        key = kmonad_aliases.get(key, key)
-        if len(key) == 1 and key.isalpha():
-            return key.upper()
-        if key == 'XX':
-            key = ''
-        return key
-
     def __str__(self) -> str:
         return f"{self.rows}"
 
@@ -263,40 +279,49 @@ class KeyCap:
 
 class HardwareLayout:
     
-    Pattern = re.compile(r'''
-        <hardware-layout>
+    Begin = '<hardware-layout>'
+    End = '</hardware-layout>'
+
+    LabelPattern = re.compile(r'''[(]
+        \s*
+        label
+        \s+
+        (?P<name>[^\s)]+)
+        \s+
         (?P<data>.+?)
-        </hardware-layout>
-    ''', re.X | re.DOTALL)
+        [)]''', re.X | re.DOTALL)
+
+    DescPattern = re.compile(r'''[(]
+        \s*
+        description
+        \s+
+        (?P<description>[^)\\]*(?:\\.[^)\\]*)*)
+        [)]''', re.X | re.DOTALL)
 
     def __init__(self, data):
-        m = HardwareLayout.Pattern.search(data)
-        if not m:
-            raise RuntimeError("Hardware layout section ot found. ie. <hardware-layout>...</hardware-layout>")
-        data = m.group('data')
         self.keycap = KeyCap(data)
         self.options = Options(data)     
         self.description = self.get_description(data)
         self.import_labels(data)   
 
+    @staticmethod
+    def extract(text: str) -> str:
+        start = text.find(HardwareLayout.Begin)
+        end = text.find(HardwareLayout.End, start) if start >= 0 else -1
+        if end < 0:
+            raise RuntimeError("Hardware layout section ot found. ie. <hardware-layout>...</hardware-layout>")
+        return text[start + len(HardwareLayout.Begin):end]
+
     def import_labels(self, data):
-        p = re.compile(r'''[(]
-            \s*
-            label
-            \s+
-            (?P<name>[^\s)]+)
-            \s+
-            (?P<data>.+?)
-            [)]''', re.X | re.DOTALL)
-        for m in p.finditer(data):
+        for m in HardwareLayout.LabelPattern.finditer(data):
             kmonad_aliases[m.group("name")] = m.group("data")
+        _translate.cache_clear()
 
     def __str__(self) -> str:
         return f"Keycap: {self.keycap}"
 
     def get_description(self, data):
-        pattern = re.compile(r'[(]\s*description\s+(?P<description>.*?)(?<!\\)[)]', re.DOTALL | re.X)
-        m = pattern.search(data)
+        m = HardwareLayout.DescPattern.search(data)
         if m:
             return m.group("description").replace("\n", "<br />")
         return ""
@@ -310,8 +335,7 @@ class KMonadLayer:
 
     def __init__(self, name: str, data: str):
         self.name = name if name else 'defsrc'
-        lines = data.splitlines()
-        self.rows = [line.split() for line in lines]
+        self.rows = tuple(tuple(line.split()) for line in data.splitlines())
 
     def __str__(self) -> str:
         return self.__repr__()
@@ -319,12 +343,14 @@ class KMonadLayer:
     def __repr__(self) -> str:
         return f"{self.name} {self.rows}"
 
-    def __call__(self, row: int, col: int):
-        try:
-            v = self.rows[row][col]
-            return None if v == '_' else v
-        except:
-            return None
+    def grid(self, nrows: int, ncols: int):
+        grid = []
+        for r in range(nrows):
+            row = self.rows[r] if r < len(self.rows) else []
+            cells = [None if v == '_' else intern(v) for v in row[:ncols]]
+            cells.extend([None] * (ncols - len(cells)))
+            grid.append(cells)
+        return grid
 
 # +-------------------------------------------------------------------------+
 # | KMonad file compiler:                                                   |
@@ -337,50 +363,56 @@ class KMonadConfig:
         \s*
         ( (?P<src>defsrc) | (deflayer\s+(?P<layer>\S+)) )
         \s+
-        (?P<data>.+?)
-        (?<!\\)[)]''', re.X | re.DOTALL)
+        (?P<data>[^)\\]*(?:\\.[^)\\]*)*)
+        [)]''', re.X | re.DOTALL)
 
     def __init__(self, file):
         self.layers : Dict[str, KMonadLayer] = dict()
         self.first = None
-        with open(file, 'r') as f:
-            text = f.read()
-            for sec in KMonadConfig.LayoutSection.finditer(text):
-                layer = KMonadLayer(sec.group('layer'), sec.group('data'))
-                self.layers[layer.name] = layer
-                if self.first is None and sec.group('layer'):
-                    self.first = sec.group('layer')
-            self.hardware = HardwareLayout(text)
-            self.name = str(Path(file).absolute())
-            self.layout = self.build()
+        path = Path(file)
+        text = path.read_text()
+        self.hardware = HardwareLayout(HardwareLayout.extract(text))
+        for sec in KMonadConfig.LayoutSection.finditer(text):
+            layer = KMonadLayer(sec.group('layer'), sec.group('data'))
+            self.layers[layer.name] = layer
+            if self.first is None and sec.group('layer'):
+                self.first = sec.group('layer')
+        hw = self.layers['defsrc'].rows
+        nrows, ncols = len(hw), max((len(row) for row in hw), default=0)
+        layermap = self.hardware.keycap.layermap
+        self._layer_names = tuple(name for name in self.layers if name in layermap)
+        self._layer_grids = [self.layers[name].grid(nrows, ncols) for name in self._layer_names]
+        self._label_cache: Dict[tuple, str] = dict()
+        self.name = str(path.absolute())
+        self.layout = self.build()
 
     def build(self) -> str:
         hw = self.layers['defsrc'].rows
-        nrows = []
+        options = self.hardware.options.get
+        out = [f"[{{a:0, y:-1, t:{self.hardware.keycap.get_colors()}}}]"]
         for r, row in enumerate(hw):
-            nrow = []
+            out.append(",\n[")
             for c, k in enumerate(row):
-                opt = self.hardware.options(k)
+                opt = options(k)
                 if opt:
-                    nrow.append(opt)
-                nrow.append((r, c, k))
-            nrows.append(nrow)
-
-        out = [f"[{{a:0, y:-1, t:{self.hardware.keycap.get_colors()}}}]"]
-        for r in nrows:
-            row = []
-            for k in r:
-                if isinstance(k, str):
-                    row.append(k)
-                else:
-                    row.append(self.keycap(*k))
-            out.append("[" + ",".join(row) + "]")
-        out.append(f'[{{f:4,w:20,h:3,d:true,t:"#333333"}},"{self.name}<br /><br />{self.hardware.description}"]')
-        return ",\n".join(out)
+                    out.append(opt)
+                    out.append(",")
+                out.append(self.keycap(r, c, k))
+                out.append(",")
+            if row:
+                out[-1] = "]"
+            else:
+                out.append("]")
+        out.append(f',\n[{{f:4,w:20,h:3,d:true,t:"#333333"}},"{self.name}<br /><br />{self.hardware.description}"]')
+        return "".join(out)
 
     def keycap(self, row, col, key):
-        labels = {layer.name: layer(row, col) for layer in self.layers.values()}
-        return self.hardware.keycap.label(labels)
+        sig = tuple(grid[row][col] for grid in self._layer_grids)
+        label = self._label_cache.get(sig)
+        if label is None:
+            label = self.hardware.keycap.label(dict(zip(self._layer_names, sig)))
+            self._label_cache[sig] = label
+        return label
 
     def __str__(self) -> str:
         return f"{self.layers}\n{self.hardware}"